@@ -1,15 +1,26 @@
 # aconex_mcp.py
+#
+# Start command (Render):
+#   uvicorn aconex_mcp:app --host 0.0.0.0 --port $PORT --workers $(nproc) --loop uvloop --http httptools
+# Cada worker es un proceso aparte con su propio cache de token, lock y pool HTTP.
 from __future__ import annotations
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Tuple, Callable, Awaitable, Hashable, NoReturn
 from time import time
+from contextlib import asynccontextmanager
 
+import asyncio
+import copy
+import logging
 import os
-import requests
+import re
+import urllib.parse
+import anyio
+import orjson
 import xmltodict
 import httpx
 
-from fastapi import FastAPI, HTTPException, Query, Response
-from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from fastapi import FastAPI, HTTPException, Query, Header, Depends, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse, PlainTextResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 # ==========================
@@ -30,116 +41,319 @@ ACONEX_SCOPE = os.getenv("ACONEX_SCOPE", "").strip()
 # Proyecto por defecto (para no tener que mandar projectId siempre)
 DEFAULT_PROJECT_ID = os.getenv("ACONEX_DEFAULT_PROJECT_ID")  # ej: "1207982555"
 
+# Orígenes CORS separados por coma (ej: "https://chatgpt.com,https://chat.openai.com")
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
+
 HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60"))  # segundos
+# Pool hacia Aconex (HTTP/2 multiplexa varios requests por conexión)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "50"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "300"))  # segundos
+HTTP_CONNECT_RETRIES = int(os.getenv("HTTP_CONNECT_RETRIES", "2"))
+# Máximo de requests simultáneos a Aconex por proceso; el resto hace cola
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "64"))
+# Tamaño de chunk para download_file; con 64 KiB el overhead por iteración en
+# Python dominaba (benchmark del PR #319 del Databricks SDK). Con 1 MiB hay
+# menos send() ASGI por MB transferido.
+DOWNLOAD_CHUNK = int(os.getenv("DOWNLOAD_CHUNK_BYTES", str(1024 * 1024)))
+# Si Aconex redirige la descarga a una URL firmada de otro host, devolver un 307
+# para que el cliente la baje directo en vez de pasar cada byte por acá
+DOWNLOAD_REDIRECT = os.getenv("DOWNLOAD_REDIRECT", "0") == "1"
+# XML más grande que esto se parsea en un thread (no bloquea el event loop)
+XML_THREAD_MIN_BYTES = 256 * 1024
+# El schema del register cambia muy poco: se cachea por proyecto (segundos)
+SCHEMA_TTL = float(os.getenv("SCHEMA_TTL", "600"))
+SCHEMA_CACHE_MAX = int(os.getenv("SCHEMA_CACHE_MAX", "256"))  # proyectos
+# Resultados de search_register: TTL corto, el agente repite las mismas páginas
+SEARCH_TTL = float(os.getenv("SEARCH_TTL", "60"))
+SEARCH_CACHE_MAX = int(os.getenv("SEARCH_CACHE_MAX", "1024"))
+# Tope del pre-warm del token al arrancar (segundos); después se reintenta on-demand
+TOKEN_PREFETCH_TIMEOUT = float(os.getenv("TOKEN_PREFETCH_TIMEOUT", "5"))
+
+log = logging.getLogger("aconex_mcp")
 
 # ==========================
 # App FastAPI
 # ==========================
-app = FastAPI(title="Aconex MCP", version="2.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Ver start command arriba: sin --loop uvloop el throughput cae bastante
+    loop_cls = type(asyncio.get_running_loop())
+    if loop_cls.__module__.startswith("uvloop"):
+        log.info("event loop: uvloop")
+    else:
+        log.warning("event loop: %s.%s (no uvloop)", loop_cls.__module__, loop_cls.__name__)
+    # Un solo cliente HTTP por proceso: reutiliza conexiones keep-alive a Aconex
+    # (sin handshake TCP+TLS por request) y no bloquea el event loop.
+    app.state.http = httpx.AsyncClient(
+        base_url=ACONEX_BASE,
+        headers={"Accept": "application/json", "User-Agent": "aconex-mcp/2.0"},
+        timeout=httpx.Timeout(HTTP_TIMEOUT),
+        # Con transport explícito, http2/limits van acá (el cliente los ignora)
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            retries=HTTP_CONNECT_RETRIES,  # solo reintenta fallas de conexión
+        ),
+        follow_redirects=True,  # igual que requests.get
+    )
+    # Cliente aparte para IDCS (otro host): los refresh reusan la conexión HTTPS
+    app.state.oauth_http = httpx.AsyncClient(
+        base_url=ACONEX_OAUTH_BASE,
+        timeout=30.0,
+        limits=httpx.Limits(max_keepalive_connections=2),
+    )
+    try:
+        # Pre-warm del token: el primer request real ya lo encuentra en cache.
+        # No es fatal y tiene tope corto, así la app arranca aunque IDCS esté caído.
+        try:
+            await asyncio.wait_for(_get_access_token(), TOKEN_PREFETCH_TIMEOUT)
+        except Exception as e:
+            log.warning("prefetch del token falló: %s", getattr(e, "detail", None) or repr(e))
+        yield
+    finally:
+        await app.state.oauth_http.aclose()
+        await app.state.http.aclose()
+
+app = FastAPI(
+    title="Aconex MCP", version="2.0.0", lifespan=lifespan,
+    default_response_class=ORJSONResponse,  # orjson (C) en vez de json.dumps
+)
 
-# CORS abierto para que el builder de ChatGPT/otros clientes llamen sin trabas
+# CORS abierto para que el builder de ChatGPT/otros clientes llamen sin trabas.
+# Sin cookies (el Bearer lo pone el server), así que no hace falta credentials;
+# el preflight se cachea un día en el browser.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"], allow_credentials=True,
-    allow_methods=["*"], allow_headers=["*"],
+    allow_origins=CORS_ORIGINS, allow_credentials=False,
+    allow_methods=["GET", "HEAD"], allow_headers=["*"],
+    max_age=86400,
 )
 
 # ==========================
 # Helpers
 # ==========================
-def _effective_project_id(pid: Optional[str]) -> str:
-    if pid:
-        return pid
-    if DEFAULT_PROJECT_ID:
-        return DEFAULT_PROJECT_ID
+def _missing_project_id() -> NoReturn:
     raise HTTPException(400, "Falta projectId y no hay ACONEX_DEFAULT_PROJECT_ID configurado")
 
-def _as_json(resp: requests.Response):
-    """Devuelve JSON si viene JSON; si viene XML, lo convierte a JSON; si no, texto plano."""
+async def _effective_project_id(projectId: Optional[str] = Query(default=None)) -> str:
+    # Dependencia (async para no pasar por el threadpool): Depends(_effective_project_id)
+    return projectId or DEFAULT_PROJECT_ID or _missing_project_id()
+
+# Content-Disposition (RFC 6266): filename*=charset'lang'valor tiene prioridad sobre filename=
+_FN_EXT_RE = re.compile(r"filename\*\s*=\s*(UTF-8|ISO-8859-1)'[^']*'([^;\s]+)", re.I)
+_FN_RE = re.compile(r'filename\s*=\s*"?([^";]+)"?', re.I)
+
+def _disposition_filename(disp: str) -> Optional[str]:
+    m = _FN_EXT_RE.search(disp)
+    if m:
+        return urllib.parse.unquote(m.group(2), encoding=m.group(1), errors="replace") or None
+    m = _FN_RE.search(disp)
+    if m:
+        return m.group(1).strip() or None
+    return None
+
+_CTRL_RE = re.compile(r"[\x00-\x1f\x7f-\x9f]")
+
+def _attachment_header(fname: str) -> str:
+    # El nombre viene de upstream: sin caracteres de control (CR/LF) ni \ o "
+    # que rompan el valor entre comillas
+    fname = _CTRL_RE.sub("", fname)
+    quoted = fname.replace("\\", "_").replace('"', "_")
+    try:
+        fname.encode("latin-1")
+    except UnicodeEncodeError:
+        # Los headers viajan en latin-1: mandamos fallback ASCII + filename* en UTF-8
+        fallback = quoted.encode("ascii", "replace").decode("ascii")
+        return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{urllib.parse.quote(fname, safe='')}"
+    return f'attachment; filename="{quoted}"'
+
+def _parse_xml(body: bytes) -> dict:
+    """XML → dict. Recibe bytes (sin decodificar a str); xmltodict ya activa
+    buffer_text en expat, y las entidades quedan deshabilitadas."""
+    return xmltodict.parse(body, process_namespaces=False, disable_entities=True)
+
+async def _as_json(resp: httpx.Response):
+    """Devuelve JSON si viene JSON; si viene XML, lo convierte a JSON; si no, el body tal cual."""
     ctype = (resp.headers.get("Content-Type") or "").lower()
-    if "application/json" in ctype:
-        try:
-            data = resp.json()
-        except Exception:
-            data = {"raw": resp.text}
-        return JSONResponse(data, status_code=resp.status_code)
+    if "json" in ctype:
+        # Ya es JSON (incluye +json, p.ej. problem+json): se reenvían los bytes
+        # tal cual, sin intentar parsearlo como XML ni re-serializarlo
+        return Response(content=resp.content, status_code=resp.status_code, media_type="application/json")
+    body = resp.content
+    if ctype and "xml" not in ctype:
+        # Ni JSON ni XML (HTML de error, texto...): sin decodificar ni intentar parsear
+        return Response(content=body, status_code=resp.status_code, media_type=resp.headers["Content-Type"])
     try:
-        data = xmltodict.parse(resp.text)
+        if len(body) > XML_THREAD_MIN_BYTES:
+            data = await anyio.to_thread.run_sync(_parse_xml, body)
+        else:
+            data = _parse_xml(body)
     except Exception:
         return PlainTextResponse(resp.text, status_code=resp.status_code)
-    return JSONResponse(data, status_code=resp.status_code)
+    return ORJSONResponse(data, status_code=resp.status_code)
 
 # Cache simple del access token en memoria
-_TOKEN: Dict[str, Any] = {"value": None, "exp": 0}
+class _TokenCache:
+    __slots__ = ("value", "exp")
+
+    def __init__(self) -> None:
+        self.value: Optional[str] = None
+        self.exp = 0.0
+
+_TOKEN = _TokenCache()
+# Un solo refresh en vuelo: los que esperan reutilizan el token recién guardado
+_TOKEN_LOCK = asyncio.Lock()
 
 async def _get_access_token() -> str:
     """Obtiene (y cachea) un access_token por client_credentials."""
-    now = time()
-    if _TOKEN["value"] and (_TOKEN["exp"] - now) > 60:
-        return _TOKEN["value"]
+    if _TOKEN.value and (_TOKEN.exp - time()) > 60:
+        return _TOKEN.value
 
-    if not ACONEX_CLIENT_ID or not ACONEX_CLIENT_SECRET:
-        raise HTTPException(500, "Falta configurar ACONEX_CLIENT_ID / ACONEX_CLIENT_SECRET en Render")
+    async with _TOKEN_LOCK:
+        # Re-chequeo: otra corrutina pudo haberlo renovado mientras esperábamos
+        now = time()
+        if _TOKEN.value and (_TOKEN.exp - now) > 60:
+            return _TOKEN.value
 
-    data = {"grant_type": "client_credentials"}
-    if ACONEX_SCOPE:
-        data["scope"] = ACONEX_SCOPE
+        if not ACONEX_CLIENT_ID or not ACONEX_CLIENT_SECRET:
+            raise HTTPException(500, "Falta configurar ACONEX_CLIENT_ID / ACONEX_CLIENT_SECRET en Render")
 
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        r = await client.post(
-            f"{ACONEX_OAUTH_BASE}/token",
+        data = {"grant_type": "client_credentials"}
+        if ACONEX_SCOPE:
+            data["scope"] = ACONEX_SCOPE
+
+        r = await app.state.oauth_http.post(
+            "/token",
             data=data,
             auth=(ACONEX_CLIENT_ID, ACONEX_CLIENT_SECRET),
         )
 
-    if r.status_code != 200:
-        # Exponemos texto para diagnóstico (invalid_client / unsupported_grant_type / invalid_scope)
-        raise HTTPException(502, f"Token error {r.status_code}: {r.text}")
+        if r.status_code != 200:
+            # Exponemos texto para diagnóstico (invalid_client / unsupported_grant_type / invalid_scope)
+            raise HTTPException(502, f"Token error {r.status_code}: {r.text}")
+
+        tok = orjson.loads(r.content)
+        access = tok.get("access_token")
+        if not access:
+            raise HTTPException(502, "Token sin access_token en respuesta de IDCS")
+        expires_in = int(tok.get("expires_in", 1800))
+        _TOKEN.value = access
+        _TOKEN.exp = now + expires_in
+        return access
+
+_UPSTREAM_SEM = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+
+async def _aconex_get(path: str, token: str, params: Optional[dict] = None) -> httpx.Response:
+    """GET a Aconex con el Bearer del server, respetando el límite de concurrencia."""
+    async with _UPSTREAM_SEM:
+        return await app.state.http.get(path, params=params, headers={"Authorization": f"Bearer {token}"})
 
-    tok = r.json()
-    access = tok.get("access_token")
-    if not access:
-        raise HTTPException(502, "Token sin access_token en respuesta de IDCS")
-    expires_in = int(tok.get("expires_in", 1800))
-    _TOKEN["value"] = access
-    _TOKEN["exp"] = now + expires_in
-    return access
+# Requests idénticos en vuelo comparten un único fetch upstream (request collapsing)
+_INFLIGHT: Dict[tuple, asyncio.Task] = {}
+
+def _inflight_done(key: tuple, task: asyncio.Task) -> None:
+    if _INFLIGHT.get(key) is task:
+        del _INFLIGHT[key]
+    if not task.cancelled():
+        task.exception()  # marcado como leído aunque nadie esté esperando
+
+async def _coalesced(key: tuple, fetch: Callable[[], Awaitable[Response]]) -> Response:
+    task = _INFLIGHT.get(key)
+    if task is None:
+        # El fetch corre en su propia task: que corte el primer cliente no
+        # cancela a los demás (y el resultado igual llega al cache)
+        task = asyncio.ensure_future(fetch())
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda t: _inflight_done(key, t))
+    try:
+        return await asyncio.shield(task)
+    except HTTPException as e:
+        # Copia por request: Starlette le cuelga __traceback__/__context__ a la
+        # excepción y no conviene compartir un mismo objeto entre requests
+        raise HTTPException(e.status_code, e.detail, e.headers) from e
+    except Exception as e:
+        try:
+            err = copy.copy(e)
+        except Exception:
+            raise e from None
+        raise err from e
+
+class _TTLCache:
+    """Cache en memoria de respuestas ya serializadas: key -> (body, media type).
+    Expira por TTL y, si se llena, descarta la entrada más vieja."""
+    __slots__ = ("ttl", "maxsize", "_data")
+
+    def __init__(self, ttl: float, maxsize: int) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: Dict[Hashable, Tuple[float, bytes, str]] = {}
+
+    def get(self, key: Hashable) -> Optional[Tuple[bytes, str]]:
+        hit = self._data.get(key)
+        if hit is None:
+            return None
+        if hit[0] <= time():
+            self._data.pop(key, None)
+            return None
+        return hit[1], hit[2]
+
+    def put(self, key: Hashable, body: bytes, media: str) -> None:
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        self._data.pop(key, None)
+        if len(self._data) >= self.maxsize:
+            # dict conserva orden de inserción: el primero es el más viejo
+            self._data.pop(next(iter(self._data)))
+        self._data[key] = (time() + self.ttl, body, media)
 
 # ==========================
 # Rutas base / health / debug
 # ==========================
+# Cuerpos estáticos: solo dependen de env vars leídas al importar, así que se
+# serializan una vez (los probes de /healthz pegan cada pocos segundos)
+_ROOT_BODY = orjson.dumps({"ok": True, "service": "aconex-mcp"})
+_HEALTH_BODY = orjson.dumps({
+    "ok": True,
+    "aconex_base": ACONEX_BASE,
+    "default_project": DEFAULT_PROJECT_ID
+})
+_DEBUG_ENV_BODY = orjson.dumps({
+    "ok": True,
+    "aconex_base": ACONEX_BASE,
+    "has_client_id": bool(ACONEX_CLIENT_ID),
+    "has_client_secret": bool(ACONEX_CLIENT_SECRET),
+    "has_scope": bool(ACONEX_SCOPE),
+    "default_project": DEFAULT_PROJECT_ID
+})
+_FAVICON = Response(b"", status_code=204)
+_HEALTH_HEAD = Response(status_code=200)
+
 @app.get("/")
 @app.head("/")
-def root():
-    return {"ok": True, "service": "aconex-mcp"}
+async def root():
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 @app.get("/favicon.ico")
-def favicon():
-    return PlainTextResponse("", status_code=204)
+async def favicon():
+    return _FAVICON
 
 @app.get("/healthz")
-def healthz_get():
-    return {
-        "ok": True,
-        "aconex_base": ACONEX_BASE,
-        "default_project": DEFAULT_PROJECT_ID
-    }
+async def healthz_get():
+    return Response(content=_HEALTH_BODY, media_type="application/json")
 
 @app.head("/healthz")
-def healthz_head():
-    return Response(status_code=200)
+async def healthz_head():
+    return _HEALTH_HEAD
 
 # Endpoints de diagnóstico (no exponen secretos)
 @app.get("/debug_env")
-def debug_env():
-    return {
-        "ok": True,
-        "aconex_base": ACONEX_BASE,
-        "has_client_id": bool(ACONEX_CLIENT_ID),
-        "has_client_secret": bool(ACONEX_CLIENT_SECRET),
-        "has_scope": bool(ACONEX_SCOPE),
-        "default_project": DEFAULT_PROJECT_ID
-    }
+async def debug_env():
+    return Response(content=_DEBUG_ENV_BODY, media_type="application/json")
 
 @app.get("/debug_token")
 async def debug_token():
@@ -148,31 +362,34 @@ async def debug_token():
         return {
             "ok": True,
             "token_prefix": t[:16],
-            "expires_in_sec": int(_TOKEN["exp"] - time())
+            "expires_in_sec": int(_TOKEN.exp - time())
         }
     except HTTPException as e:
-        return JSONResponse({"ok": False, "status": e.status_code, "detail": e.detail}, status_code=200)
+        return ORJSONResponse({"ok": False, "status": e.status_code, "detail": e.detail}, status_code=200)
     except Exception as e:
-        return JSONResponse({"ok": False, "status": 500, "detail": str(e)}, status_code=200)
+        return ORJSONResponse({"ok": False, "status": 500, "detail": str(e)}, status_code=200)
 
 # ==========================
 # Endpoints Aconex (server-side Bearer)
 # ==========================
+_SEARCH_CACHE = _TTLCache(ttl=SEARCH_TTL, maxsize=SEARCH_CACHE_MAX)
+_DEFAULT_RETURN_FIELDS = "docno,title,statusid,revision,registered"
+_SEARCH_PARAMS = {"search_type": "PAGED"}  # fijos en toda búsqueda
+
 @app.get("/search_register")
 @app.get("/search_register/")   # alias con barra final
 @app.get("/searchRegister")     # alias camelCase por si algún cliente lo usa así
 async def search_register(
-    projectId: Optional[str] = Query(default=None),
+    pid: str = Depends(_effective_project_id),
     page_number: int = 1,
     page_size: int = 50,
     search_query: Optional[str] = None,
-    return_fields: str = "docno,title,statusid,revision,registered",
+    return_fields: str = _DEFAULT_RETURN_FIELDS,
+    # "X-No-Cache: 1" fuerza ir a Aconex; switch de operador, fuera del OpenAPI de la Action
+    x_no_cache: Optional[str] = Header(default=None, include_in_schema=False),
 ):
-    token = await _get_access_token()
-    pid = _effective_project_id(projectId)
-
     params = {
-        "search_type": "PAGED",
+        **_SEARCH_PARAMS,
         "page_number": page_number,
         "page_size": page_size,
         "return_fields": return_fields,
@@ -180,64 +397,112 @@ async def search_register(
     if search_query:
         params["search_query"] = search_query
 
-    url = f"{ACONEX_BASE}/projects/{pid}/register"
-    resp = requests.get(
-        url,
-        headers={"Authorization": f"Bearer {token}", "Accept": "application/json"},
-        params=params,
-        timeout=HTTP_TIMEOUT,
-    )
-    return _as_json(resp)
+    key = ("search_register", pid, frozenset(params.items()))
+    if x_no_cache != "1":
+        hit = _SEARCH_CACHE.get(key)
+        if hit:
+            return Response(content=hit[0], media_type=hit[1])
+
+    async def fetch():
+        token = await _get_access_token()
+        resp = await _aconex_get(f"/projects/{pid}/register", token, params)
+        out = await _as_json(resp)
+        if resp.status_code == 200:
+            _SEARCH_CACHE.put(key, out.body, out.headers["content-type"])
+        return out
+
+    return await _coalesced(key, fetch)
+
+_SCHEMA_CACHE = _TTLCache(ttl=SCHEMA_TTL, maxsize=SCHEMA_CACHE_MAX)
 
 @app.get("/register_schema")
 @app.get("/registerSchema")
-async def register_schema(projectId: Optional[str] = Query(default=None)):
-    token = await _get_access_token()
-    pid = _effective_project_id(projectId)
-    url = f"{ACONEX_BASE}/projects/{pid}/register/schema"
-    resp = requests.get(
-        url, headers={"Authorization": f"Bearer {token}", "Accept": "application/json"},
-        timeout=HTTP_TIMEOUT,
-    )
-    return _as_json(resp)
+async def register_schema(pid: str = Depends(_effective_project_id)):
+    hit = _SCHEMA_CACHE.get(pid)
+    if hit:
+        return Response(content=hit[0], media_type=hit[1])
+
+    async def fetch():
+        token = await _get_access_token()
+        resp = await _aconex_get(f"/projects/{pid}/register/schema", token)
+        out = await _as_json(resp)
+        if resp.status_code == 200:
+            _SCHEMA_CACHE.put(pid, out.body, out.headers["content-type"])
+        return out
+
+    # Un fetch por proyecto a la vez; los demás comparten la misma respuesta
+    return await _coalesced(("register_schema", pid), fetch)
 
 @app.get("/document_metadata")
 @app.get("/documentMetadata")
-async def document_metadata(projectId: Optional[str] = Query(default=None), documentId: str = ""):
+async def document_metadata(pid: str = Depends(_effective_project_id), documentId: str = ""):
     if not documentId:
         raise HTTPException(400, "Falta documentId")
-    token = await _get_access_token()
-    pid = _effective_project_id(projectId)
-    url = f"{ACONEX_BASE}/projects/{pid}/register/{documentId}/metadata"
-    resp = requests.get(
-        url, headers={"Authorization": f"Bearer {token}", "Accept": "application/json"},
-        timeout=HTTP_TIMEOUT,
-    )
-    return _as_json(resp)
+
+    async def fetch():
+        token = await _get_access_token()
+        resp = await _aconex_get(f"/projects/{pid}/register/{documentId}/metadata", token)
+        return await _as_json(resp)
+
+    return await _coalesced(("document_metadata", pid, documentId), fetch)
 
 @app.get("/download_file")
 @app.get("/downloadFile")
-async def download_file(projectId: Optional[str] = Query(default=None), documentId: str = ""):
+async def download_file(pid: str = Depends(_effective_project_id), documentId: str = ""):
     if not documentId:
         raise HTTPException(400, "Falta documentId")
     token = await _get_access_token()
-    pid = _effective_project_id(projectId)
-    url = f"{ACONEX_BASE}/projects/{pid}/register/{documentId}/file"
-    upstream = requests.get(
-        url, headers={"Authorization": f"Bearer {token}"},
-        stream=True, timeout=max(HTTP_TIMEOUT, 300),
+    client: httpx.AsyncClient = app.state.http
+    req = client.build_request(
+        "GET", f"/projects/{pid}/register/{documentId}/file",
+        # Binario, no JSON; sin compresión para que Content-Length sea el real
+        headers={"Authorization": f"Bearer {token}", "Accept": "*/*", "Accept-Encoding": "identity"},
+        timeout=max(HTTP_TIMEOUT, 300),
     )
-    # Propaga nombre de archivo si viene en Content-Disposition
-    fname = None
-    disp = upstream.headers.get("Content-Disposition") or ""
-    if "filename=" in disp:
+    # El semáforo cubre hasta recibir los headers, no todo el streaming del body
+    async with _UPSTREAM_SEM:
+        upstream = await client.send(req, stream=True, follow_redirects=not DOWNLOAD_REDIRECT)
+    if upstream.is_redirect:
+        location = upstream.url.join(upstream.headers["Location"])
+        await upstream.aclose()
+        if location.host != upstream.url.host:
+            return RedirectResponse(str(location), status_code=307)
+        # Redirect dentro de Aconex: necesita el Bearer, lo seguimos nosotros
+        # desde el request que httpx ya armó (sin volver a pedir el 302)
+        async with _UPSTREAM_SEM:
+            upstream = await client.send(upstream.next_request, stream=True, follow_redirects=True)
+    if upstream.is_error:
+        # 401/404/5xx: se devuelve el error con su status, no como un adjunto 200
         try:
-            fname = disp.split("filename=", 1)[1].strip("\"'; ")
-        except Exception:
-            fname = None
-    media = upstream.headers.get("Content-Type") or "application/octet-stream"
+            await upstream.aread()
+        finally:
+            await upstream.aclose()
+        return await _as_json(upstream)
+
+    async def body_iter():
+        # Cierra la conexión upstream al terminar o si el cliente corta
+        try:
+            async for chunk in upstream.aiter_raw(chunk_size=DOWNLOAD_CHUNK):
+                yield chunk
+        finally:
+            await upstream.aclose()
+
+    # Propaga nombre de archivo si viene en Content-Disposition
+    fname = _disposition_filename(upstream.headers.get("Content-Disposition") or "")
+    headers = {"Content-Disposition": _attachment_header(fname or (documentId + ".bin"))}
+    # Los bytes se reenvían tal cual (aiter_raw): con Content-Length conocido
+    # uvicorn escribe el cuerpo directo, sin framing chunked
+    for h in ("Content-Length", "Content-Encoding"):
+        if h in upstream.headers:
+            headers[h] = upstream.headers[h]
     return StreamingResponse(
-        upstream.iter_content(64 * 1024),
-        media_type=media,
-        headers={"Content-Disposition": f'attachment; filename="{fname or (documentId + ".bin")}"'},
+        body_iter(),
+        media_type=upstream.headers.get("Content-Type", "application/octet-stream"),
+        headers=headers,
     )
+
+# Cada (ruta, método) se registra una sola vez: con duplicados gana el primer
+# handler declarado y el otro queda muerto en la tabla de rutas
+_ROUTE_KEYS = [(r.path, m) for r in app.router.routes for m in (getattr(r, "methods", None) or ())]
+if len(set(_ROUTE_KEYS)) != len(_ROUTE_KEYS):
+    raise RuntimeError("Ruta duplicada en aconex_mcp")